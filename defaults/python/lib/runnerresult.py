@@ -16,6 +16,7 @@ class Result(Enum):
     StreamFailedToStart = "Stream failed to start!"
     StreamDidNotEnd = "Stream did not end in time!"
     AppLaunchFailed = "Failed to launch app in time!"
+    AppForeverUpdating = "App is forever updating..."
     MoonlightClosed = "Moonlight has been closed!"
     MoonlightIsNotInstalled = "Moonlight executable/flatpak not found!"
 
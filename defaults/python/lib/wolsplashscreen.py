@@ -164,4 +164,10 @@ class WolSplashScreen:
             return False
         
         self.loading_text.set_text(text="Waiting for the host...")
-        return True
\ No newline at end of file
+        return True
+
+    def time_left(self) -> float:
+        if self.close_flag or self.destroy_flag:
+            return 0
+
+        return max(0, (self.timeout_end - datetime.now(timezone.utc)).total_seconds())
\ No newline at end of file
@@ -13,6 +13,7 @@ def add_plugin_to_path():
 
 add_plugin_to_path()
 
+from dataclasses import dataclass
 from enum import Enum
 from typing import Optional, TypedDict
 from lib.moonlightproxy import MoonlightProxy, ResolutionDimensions
@@ -24,18 +25,18 @@ from lib.wolsplashscreen import WolSplashScreen
 
 import os
 import asyncio
+import contextlib
+import functools
+import random
 import lib.constants as constants
 import lib.hostinfo as hostinfo
+import externals.async_timeout as async_timeout
 import lib.runnerresult as runnerresult
 # autopep8: on
 
 set_log_filename(constants.RUNNER_LOG_FILE, rotate=False)
 
 
-class SpecialHandling(Enum):
-    AppFinishedUpdating = "App is forever updating..."
-
-
 class ResolutionChange(TypedDict):
     dimensions: ResolutionDimensions
     passToBuddy: bool
@@ -47,100 +48,120 @@ class MoonDeckResolution(TypedDict):
     height: int
 
 
-async def sleep_before_return_if_false(value):
-    if value is False:
-        await asyncio.sleep(1)
-    return value
+@dataclass
+class RetryState:
+    retries: int
+
+
+class LaunchPhase(Enum):
+    StreamReadiness = 0
+    AppLaunchRequest = 1
+    AppLaunch = 2
+    AppClose = 3
+
+
+@dataclass
+class LaunchState:
+    update_retries: int
+    phase: LaunchPhase = LaunchPhase.StreamReadiness
+    running_since: Optional[float] = None
+    was_updating: bool = False
+
+
+# Returned by the host info predicates to keep on polling, any other value is the final result
+POLL_AGAIN = object()
 
 
 async def pool_host_info(client: BuddyClient, predicate):
+    # Buddy does not push any state changes to us, therefore the predicates
+    # only inspect the info and the (cancellable) sleep between the polls is done here
     while True:
         info = await client.get_host_info()
         if not isinstance(info, dict):
             return info
 
-        result = await predicate(info)
-        if isinstance(result, bool) or result is None:
-            if result:
-                return None
-        else:
+        result = predicate(info)
+        if result is not POLL_AGAIN:
             return result
 
-
-async def sleep_while_counting_down(object_ref, error: runnerresult.Result):
-    object_ref["retries"] -= 1
-    if object_ref["retries"] > 0:
-        return await sleep_before_return_if_false(False)
-    else:
-        return error
-
-
-async def wait_for_app_to_close(client: BuddyClient, app_id: int):
-    async def wait_till_close(info: HostInfoResponse):
-        if info["steamRunningAppId"] != app_id or not info["steamIsRunning"]:
-            return True
-
         await asyncio.sleep(1)
 
-    return await pool_host_info(client, wait_till_close)
 
+def count_down(state: RetryState, error: runnerresult.Result):
+    state.retries -= 1
+    return POLL_AGAIN if state.retries > 0 else error
 
-async def wait_for_stream_to_stop(client: BuddyClient, timeouts: RunnerTimeouts):
-    obj = {"retries": timeouts["streamEnd"]}
-    if obj["retries"] <= 0:
-        return None
 
-    async def wait_to_stop(info: HostInfoResponse):
-        if info["streamState"] == StreamState.NotStreaming:
-            return True
+def reset_deadline(deadline: async_timeout.Timeout, timeout: int):
+    # Zero would expire the deadline right away, while we want to give the phase at least a single poll
+    deadline.update(asyncio.get_running_loop().time() + max(timeout, 1))
 
-        return await sleep_while_counting_down(obj, runnerresult.Result.StreamDidNotEnd)
 
-    return await pool_host_info(client, wait_to_stop)
+async def sleep_unless_set(event: asyncio.Event, delay: float):
+    with contextlib.suppress(asyncio.TimeoutError):
+        await asyncio.wait_for(event.wait(), timeout=delay)
 
 
-async def wait_for_app_launch(client: BuddyClient, app_id: int, timeouts: RunnerTimeouts):
-    obj = {"retries": timeouts["appLaunch"], "stability_counter": timeouts["appLaunchStability"], "was_updating": False}
+def update_launch_state(state: LaunchState, app_id: int, timeouts: RunnerTimeouts, deadline: async_timeout.Timeout, info: HostInfoResponse):
+    if state.phase == LaunchPhase.StreamReadiness:
+        if info["streamState"] == StreamState.Streaming:
+            state.phase = LaunchPhase.AppLaunchRequest
+        return POLL_AGAIN
 
-    async def wait_till_launch(info: HostInfoResponse):
+    if state.phase == LaunchPhase.AppLaunch:
         if info["steamIsRunning"]:
             if info["steamRunningAppId"] == app_id:
-                # Reset the retry counter to the initial value for even more stability...
-                obj["retries"] = timeouts["appLaunch"]
-
-                # Counter is needed for apps that come with brain-dead launcher (EALink for example)
-                obj["stability_counter"] -= 1
+                # Reset the deadline for even more stability...
+                reset_deadline(deadline, timeouts["appLaunch"])
 
+                # Stability check is needed for apps that come with brain-dead launcher (EALink for example).
                 # Usual the Steam app state changes rapidly with launchers, so if it stays
                 # consistent for like 15s, it should be good enough for us
-                return await sleep_before_return_if_false(obj["stability_counter"] == 0)
+                now = asyncio.get_running_loop().time()
+                if state.running_since is None:
+                    state.running_since = now
+
+                if now - state.running_since >= timeouts["appLaunchStability"]:
+                    logger.info("Waiting for app or Steam to close")
+                    state.phase = LaunchPhase.AppClose
+                    deadline.reject()
+                return POLL_AGAIN
             else:
-                # See note above, we are want the app id to stay consistent for 10s
-                obj["stability_counter"] = timeouts["appLaunchStability"]
+                # See note above, we are want the app id to stay consistent
+                state.running_since = None
 
                 if info["steamTrackedUpdatingAppId"] == app_id:
-                    obj["was_updating"] = True
-                    return await sleep_before_return_if_false(False)
-                elif obj["was_updating"]:
-                    # If the app is no longer updating we need to re-launch it by
-                    # returning this special value
-                    return SpecialHandling.AppFinishedUpdating
+                    # The update can take a while, the deadline only applies once it's done
+                    reset_deadline(deadline, timeouts["appLaunch"])
+                    state.was_updating = True
+                    return POLL_AGAIN
+                elif state.was_updating:
+                    # If the app is no longer updating we need to re-launch it
+                    state.phase = LaunchPhase.AppLaunchRequest
+                    return POLL_AGAIN
+
+        return POLL_AGAIN
+
+    assert state.phase == LaunchPhase.AppClose, f"Unexpected launch phase {state.phase}"
+    if info["steamRunningAppId"] != app_id or not info["steamIsRunning"]:
+        return None
 
-        return await sleep_while_counting_down(obj, runnerresult.Result.AppLaunchFailed)
+    return POLL_AGAIN
 
-    return await pool_host_info(client, wait_till_launch)
 
+def wait_till_stream_stops(state: RetryState, info: HostInfoResponse):
+    if info["streamState"] == StreamState.NotStreaming:
+        return None
 
-async def wait_for_stream_to_be_ready(client: BuddyClient, timeouts: RunnerTimeouts):
-    obj = {"retries": timeouts["streamReadiness"]}
+    return count_down(state, runnerresult.Result.StreamDidNotEnd)
 
-    async def wait_till_stream_is_ready(info: HostInfoResponse):
-        if info["streamState"] == StreamState.Streaming:
-            return True
 
-        return await sleep_while_counting_down(obj, runnerresult.Result.StreamFailedToStart)
+async def wait_for_stream_to_stop(client: BuddyClient, timeouts: RunnerTimeouts):
+    state = RetryState(retries=timeouts["streamEnd"])
+    if state.retries <= 0:
+        return None
 
-    return await pool_host_info(client, wait_till_stream_is_ready)
+    return await pool_host_info(client, functools.partial(wait_till_stream_stops, state))
 
 
 async def end_the_stream(client: BuddyClient, close_steam: bool, timeouts: RunnerTimeouts):
@@ -161,35 +182,66 @@ async def end_the_stream(client: BuddyClient, close_steam: bool, timeouts: Runne
         return result
 
 
-async def launch_app_and_wait(client: BuddyClient, app_id: int, timeouts: RunnerTimeouts):
+async def launch_app_and_wait(client: BuddyClient, app_id: int, timeouts: RunnerTimeouts, moonlight_closed: asyncio.Event):
+    state = LaunchState(update_retries=timeouts["appUpdate"])
+    info: Optional[HostInfoResponse] = None
+
+    # All of the phases are driven by a single polling loop so that the host info
+    # that completes one phase can be reused by the next one. Each phase is bound
+    # by a wall-clock deadline instead of counting the polls
     logger.info("Waiting for Steam to be ready to launch games")
-    result = await wait_for_stream_to_be_ready(client, timeouts)
-    if result:
-        return result
+    try:
+        async with async_timeout.timeout(None) as deadline:
+            reset_deadline(deadline, timeouts["streamReadiness"])
+            while True:
+                if state.phase == LaunchPhase.AppLaunchRequest:
+                    if state.update_retries <= 0:
+                        logger.info("Giving up waiting for %s to finish updating cycles", app_id)
+                        return runnerresult.Result.AppForeverUpdating
 
-    retries = timeouts["appUpdate"]
-    result = SpecialHandling.AppFinishedUpdating
-    while result == SpecialHandling.AppFinishedUpdating and retries:
-        retries -= 1
+                    state.update_retries -= 1
 
-        logger.info(f"Sending request to launch app {app_id}")
-        result = await client.launch_app(app_id)
-        if result:
-            return result
+                    # The request itself is bound by the Buddy request timeout
+                    deadline.reject()
 
-        logger.info(f"Waiting for app {app_id} to be launched in Steam")
-        result = await wait_for_app_launch(client, app_id, timeouts)
-        if result and result != SpecialHandling.AppFinishedUpdating:
-            return result 
+                    logger.info("Sending request to launch app %s", app_id)
+                    result = await client.launch_app(app_id)
+                    if result:
+                        return result
 
-    if result:
-        logger.info(f"Giving up waiting for {app_id} to finish updating cycles")
-        return result    
+                    logger.info("Waiting for app %s to be launched in Steam", app_id)
+                    state.phase = LaunchPhase.AppLaunch
+                    state.running_since = None
+                    state.was_updating = False
+                    reset_deadline(deadline, timeouts["appLaunch"])
+                    info = None
+
+                if info is None:
+                    info = await client.get_host_info()
+                    if not isinstance(info, dict):
+                        return info
+
+                phase = state.phase
+                result = update_launch_state(state, app_id, timeouts, deadline, info)
+                if result is not POLL_AGAIN:
+                    return result
 
-    logger.info("Waiting for app or Steam to close")
-    result = await wait_for_app_to_close(client, app_id)
-    if result:
-        return result
+                if state.phase == phase:
+                    if phase == LaunchPhase.AppClose and not moonlight_closed.is_set():
+                        # The app close phase lasts for the whole gaming session, so there is no need to poll every
+                        # second. Once Moonlight closes, poll right away to see whether the app has closed with it
+                        await sleep_unless_set(moonlight_closed, 5)
+                    else:
+                        await asyncio.sleep(1)
+                    info = None
+
+    except asyncio.TimeoutError:
+        if not deadline.expired:
+            raise
+
+        if state.phase == LaunchPhase.StreamReadiness:
+            return runnerresult.Result.StreamFailedToStart
+        return runnerresult.Result.AppLaunchFailed
 
 
 async def start_moonlight(proxy: MoonlightProxy):
@@ -204,29 +256,33 @@ async def start_moonlight(proxy: MoonlightProxy):
     await proxy.start()
 
 
-async def wait_for_initial_host_conditions(res_change: ResolutionChange, client: BuddyClient, app_id: int, timeouts: RunnerTimeouts):
-    obj = {"retries": timeouts["initialConditions"]}
+SETTLED_STREAM_STATES = frozenset((StreamState.Streaming, StreamState.NotStreaming))
+
 
-    async def wait_till_stream_to_be_ready(info: HostInfoResponse):
-        if info["streamState"] == StreamState.StreamEnding:
-            return await sleep_while_counting_down(obj, runnerresult.Result.StreamDidNotEnd)
+def wait_till_initial_conditions(state: RetryState, app_id: int, info: HostInfoResponse):
+    if info["streamState"] == StreamState.StreamEnding:
+        return count_down(state, runnerresult.Result.StreamDidNotEnd)
+
+    if info["streamState"] in SETTLED_STREAM_STATES:
+        if info["steamIsRunning"]:
+            current_app_is_running = info["steamRunningAppId"] == app_id
+            current_app_is_updating = info["steamTrackedUpdatingAppId"] == app_id
 
-        if info["streamState"] in [StreamState.Streaming, StreamState.NotStreaming]:
-            if info["steamIsRunning"]:
-                current_app_is_running = info["steamRunningAppId"] == app_id
-                current_app_is_updating = info["steamTrackedUpdatingAppId"] == app_id
+            if current_app_is_running or current_app_is_updating:
+                return None
+            elif info["steamRunningAppId"] == constants.NULL_STEAM_APP_ID:
+                return None
 
-                if current_app_is_running or current_app_is_updating:
-                    return True
-                elif current_app_is_running == constants.NULL_STEAM_APP_ID:
-                    return True
+            return count_down(state, runnerresult.Result.AnotherSteamAppIsRunning)
 
-                return await sleep_while_counting_down(obj, runnerresult.Result.AnotherSteamAppIsRunning)
+    return None
 
-        return True
+
+async def wait_for_initial_host_conditions(res_change: ResolutionChange, client: BuddyClient, app_id: int, timeouts: RunnerTimeouts):
+    state = RetryState(retries=timeouts["initialConditions"])
 
     logger.info("Waiting for a initial stream conditions to be satisfied")
-    result = await pool_host_info(client, wait_till_stream_to_be_ready)
+    result = await pool_host_info(client, functools.partial(wait_till_initial_conditions, state, app_id))
     if result:
         return result
 
@@ -245,6 +301,10 @@ async def wait_for_initial_host_conditions(res_change: ResolutionChange, client:
 async def establish_connection(client: BuddyClient, mac: str, hostInfoPort: int, timeouts: RunnerTimeouts):
     logger.info("Checking connection to Buddy and GameStream server")
 
+    get_server_info = functools.partial(hostinfo.get_server_info, client.address, hostInfoPort, timeout=timeouts["servicePing"])
+
+    server_status = False
+    delay = 0.1
     async with WolSplashScreen(client.address, mac, timeouts["wakeOnLan"]) as splash:
         while True:
             buddy_result = await client.say_hello(force=True)
@@ -253,9 +313,9 @@ async def establish_connection(client: BuddyClient, mac: str, hostInfoPort: int,
                     return buddy_result
             
             buddy_status = buddy_result != HelloResult.Offline
-            server_status = await hostinfo.get_server_info(client.address, 
-                                                           hostInfoPort, 
-                                                           timeout=timeouts["servicePing"]) is not None
+            # Once the GameStream server has answered, there is no need to keep
+            # probing it while we are still waiting for Buddy to come online
+            server_status = server_status or await get_server_info() is not None
             
             if not splash.update(buddy_status, server_status):
                 if not buddy_status:
@@ -264,11 +324,66 @@ async def establish_connection(client: BuddyClient, mac: str, hostInfoPort: int,
                     return runnerresult.Result.GameStreamDead
                 return None
 
+            # Probe often at first to catch a host that is already waking up and back off
+            # (with some jitter) for the ones that take a while to boot. The delay is clamped
+            # so that the last probe is not made way past the timeout
+            await asyncio.sleep(min(delay + random.uniform(0, 0.1), splash.time_left()))
+            delay = min(4, delay * 2)
+
+
+async def cancel_and_wait(task: asyncio.Task, timeout: float):
+    task.cancel()
+
+    # Not using `asyncio.wait_for` here as it would block indefinitely if the task swallows the cancellation
+    done, _ = await asyncio.wait({task}, timeout=timeout)
+    if task not in done:
+        logger.warning(f"Task {task.get_name()} is still running {timeout}s after being cancelled!")
+
+
+class ConcurrentExitStack:
+    # Enters the managers one after another like the `async with` nesting does, but exits them at the same time.
+    # The exception (if any) is passed to each of them, but it is never suppressed
+    def __init__(self, *managers: contextlib.AbstractAsyncContextManager, timeout: float):
+        self.managers = managers
+        self.entered = []
+        self.timeout = timeout
+
+    async def __aenter__(self):
+        results = []
+        for manager in self.managers:
+            try:
+                results.append(await manager.__aenter__())
+            except BaseException as err:
+                await self.__aexit__(type(err), err, err.__traceback__)
+                raise
+            self.entered.append(manager)
+        return tuple(results)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        entered, self.entered = self.entered, []
+        if not entered:
+            return
+
+        tasks = [asyncio.create_task(manager.__aexit__(exc_type, exc, tb), name=f"{type(manager).__name__}.__aexit__")
+                 for manager in entered]
+        _, pending = await asyncio.wait(tasks, timeout=self.timeout)
+        for task in pending:
+            await cancel_and_wait(task, timeout=2)
+
+        # Errors are re-raised (after everything had a chance to exit) just like the `async with` nesting would do
+        errors = [task.exception() for task in tasks if task.done() and not task.cancelled() and task.exception()]
+        for error in errors[1:]:
+            logger.error(f"Additional error while exiting: {error!r}")
+        if errors:
+            raise errors[0]
+
 
 async def run_game(res_change: ResolutionChange, host_app: str, hostname: str, mac: str, address: str, hostInfoPort:int, buddyPort: int, client_id: Optional[str], close_steam: bool, timeouts: RunnerTimeouts, moonlight_exec_path: Optional[str], app_id: int):
     try:
-        async with BuddyClient(address, buddyPort, client_id, timeouts["buddyRequests"]) as client, \
-                   MoonlightProxy(hostname, host_app, res_change["dimensions"] if res_change["passToMoonlight"] else None, moonlight_exec_path) as proxy:
+        # Terminating Moonlight and closing the Buddy session are independent of each other
+        async with ConcurrentExitStack(BuddyClient(address, buddyPort, client_id, timeouts["buddyRequests"]),
+                                       MoonlightProxy(hostname, host_app, res_change["dimensions"] if res_change["passToMoonlight"] else None, moonlight_exec_path),
+                                       timeout=5) as (client, proxy):
             result = await establish_connection(client=client, mac=mac, hostInfoPort=hostInfoPort, timeouts=timeouts)
             if result:
                 return result
@@ -281,35 +396,41 @@ async def run_game(res_change: ResolutionChange, host_app: str, hostname: str, m
             if result:
                 return result
 
-            proxy_task = asyncio.create_task(proxy.wait())
-            launch_task = asyncio.create_task(launch_app_and_wait(client=client, app_id=app_id, timeouts=timeouts))
+            moonlight_closed = asyncio.Event()
+            launch_task = asyncio.create_task(launch_app_and_wait(client=client, app_id=app_id, timeouts=timeouts, moonlight_closed=moonlight_closed), name="launch_task")
+            proxy_task = asyncio.create_task(proxy.wait(), name="proxy_task")
+            proxy_task.add_done_callback(lambda _: moonlight_closed.set())
+
+            try:
+                # Our own cancellation propagates from here as `asyncio.wait` does not swallow it
+                done, _ = await asyncio.wait({proxy_task, launch_task}, return_when=asyncio.FIRST_COMPLETED)
+                if launch_task not in done:
+                    # Moonlight has closed, give the launch task a chance to finish on its own
+                    done, _ = await asyncio.wait({launch_task}, timeout=2)
+                    if launch_task not in done:
+                        # It's going to be cancelled once we leave this block
+                        return runnerresult.Result.MoonlightClosed
 
-            done, _ = await asyncio.wait({proxy_task, launch_task}, return_when=asyncio.FIRST_COMPLETED)
-            if proxy_task in done:
-                done, _ = await asyncio.wait({launch_task}, timeout=2)
-                if launch_task in done:
-                    result = launch_task.result()
-                    if result:
-                        return result
-                else:
-                    launch_task.cancel()
-                    await asyncio.wait({launch_task}, timeout=2)
-                    return runnerresult.Result.MoonlightClosed
-            else:
-                assert launch_task in done, "Launch task is not done?!"  
+                result = launch_task.result()
+
+                if not proxy_task.done():
+                    logger.info("Ending stream") 
+                    end_result = await client.end_stream()
+                    if end_result:
+                        logger.error(f"Failed to end the stream: {end_result.value}")
 
-                logger.info("Ending stream") 
-                result = await client.end_stream()
                 if result:
-                    logger.error(f"Failed to end the stream: {result.value}")
+                    return result
 
-                result = launch_task.result()
+                result = await end_the_stream(client=client, close_steam=close_steam, timeouts=timeouts)
                 if result:
                     return result
-                
-            result = await end_the_stream(client=client, close_steam=close_steam, timeouts=timeouts)
-            if result:
-                return result
+            finally:
+                # Neither of the tasks may outlive the client and proxy they are using,
+                # no matter how we are leaving this block (outer cancellation included)
+                for task in (launch_task, proxy_task):
+                    if not task.done():
+                        await cancel_and_wait(task, timeout=2)
 
     except Exception:
         logger.exception("Unhandled exception")
@@ -390,6 +511,7 @@ def get_resolution_change(host_settings: HostSettings) -> ResolutionChange:
     return res_change
 
 
+@functools.lru_cache(maxsize=None)
 def get_app_id() -> Optional[int]:
     app_id = os.environ.get("MOONDECK_STEAM_APP_ID")
     try: